@@ -1,6 +1,7 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
 from trytond.pool import Pool
+from . import ir
 from . import product
 from . import stock
 
@@ -18,9 +19,17 @@ def register():
         stock.ShipmentExternal,
         stock.Period,
         stock.PeriodCacheParty,
+        stock.PartyBalance,
+        stock.PartyQuantitySnapshot,
+        stock.PartyBalanceHistory,
+        stock.PartyBalanceHistoryContext,
         stock.Inventory,
         stock.InventoryLine,
+        ir.Cron,
         module='stock_external_party', type_='model')
     Pool.register(
         product.ProductByParty,
         module='stock_external_party', type_='wizard')
+    Pool.register(
+        product.ProductByPartyExport,
+        module='stock_external_party', type_='report')
@@ -0,0 +1,19 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from trytond.pool import PoolMeta
+
+
+class Cron(metaclass=PoolMeta):
+    __name__ = 'ir.cron'
+
+    @classmethod
+    def __setup__(cls):
+        super().__setup__()
+        cls.method.selection.extend([
+                ('stock.party.balance|rebuild', "Rebuild Party Balances"),
+                ('stock.party.balance|verify', "Verify Party Balances"),
+                ('stock.period|prune_party_caches',
+                    "Prune Superseded Period Party Caches"),
+                ('stock.party.quantity.snapshot|refresh',
+                    "Compute Party Quantity Snapshots"),
+                ])
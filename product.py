@@ -1,12 +1,21 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
+import csv
 import datetime
+from io import StringIO
 
+from sql import Literal, Null
+
+from trytond import backend
+from trytond.cache import Cache
+from trytond.i18n import gettext
 from trytond.model import fields, ModelSQL, ModelView
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Eval, PYSONEncoder
+from trytond.report import Report
 from trytond.transaction import Transaction
-from trytond.wizard import Wizard, StateView, StateAction, Button
+from trytond.wizard import (Wizard, StateView, StateAction, StateReport,
+    Button)
 
 
 class Template(metaclass=PoolMeta):
@@ -21,6 +30,30 @@ class Template(metaclass=PoolMeta):
             'invisible': ~Eval('may_belong_to_party', False),
             }, depends=['active', 'may_belong_to_party'])
 
+    @classmethod
+    def create(cls, vlist):
+        pool = Pool()
+        Product = pool.get('product.product')
+        templates = super(Template, cls).create(vlist)
+        if any(v.get('may_belong_to_party') for v in vlist):
+            Product._owner_products_cache.clear()
+        return templates
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Product = pool.get('product.product')
+        super(Template, cls).write(*args)
+        if any('may_belong_to_party' in v for v in args[1::2]):
+            Product._owner_products_cache.clear()
+
+    @classmethod
+    def delete(cls, templates):
+        pool = Pool()
+        Product = pool.get('product.product')
+        super(Template, cls).delete(templates)
+        Product._owner_products_cache.clear()
+
 
 class TemplateOwnerParty(ModelSQL):
     'Template - Owner - Party'
@@ -33,6 +66,54 @@ class TemplateOwnerParty(ModelSQL):
 
 class Product(metaclass=PoolMeta):
     __name__ = 'product.product'
+    _owner_products_cache = Cache('product.product.owner_products',
+        context=False)
+
+    @classmethod
+    def get_owner_products(cls):
+        '''
+        Returns the set of the ids of the products that may have stock of a
+        party: the products of the templates that may belong to a party and
+        the products of the moves with a party.
+        '''
+        pool = Pool()
+        Template = pool.get('product.template')
+        Move = pool.get('stock.move')
+        product = cls.__table__()
+        template = Template.__table__()
+        move = Move.__table__()
+        cursor = Transaction().connection.cursor()
+
+        product_ids = cls._owner_products_cache.get(None)
+        if product_ids is None:
+            product_ids = set()
+            cursor.execute(*product.join(template,
+                    condition=product.template == template.id
+                    ).select(product.id,
+                    where=template.may_belong_to_party == Literal(True)))
+            product_ids.update(p for p, in cursor)
+            cursor.execute(*move.select(move.product,
+                    where=move.party != Null,
+                    group_by=[move.product]))
+            product_ids.update(p for p, in cursor)
+            product_ids = sorted(product_ids)
+            cls._owner_products_cache.set(None, product_ids)
+        return set(product_ids)
+
+    @classmethod
+    def add_owner_products(cls, product_ids):
+        '''
+        Clears the cache of the owner products if some of the products are not
+        in it. It must be called when a party is set on moves of the products.
+
+        The cache is also cleared when it is not filled in this process as
+        other processes may hold a set without the products.
+        '''
+        if not product_ids:
+            return
+        cached = cls._owner_products_cache.get(None)
+        if cached is None or not set(product_ids) <= set(cached):
+            cls._owner_products_cache.clear()
 
     @classmethod
     def get_cost_value(cls, products, name):
@@ -61,9 +142,11 @@ class ProductByParty(Wizard):
     start = StateView('product.by_party.start',
         'stock_external_party.product_by_party_start_view_form', [
             Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Export', 'export', 'tryton-print'),
             Button('Open', 'open', 'tryton-ok', default=True),
             ])
     open = StateAction('stock_external_party.act_party_quantity_tree')
+    export = StateReport('product.by_party.export')
 
     def do_open(self, action):
         pool = Pool()
@@ -92,3 +175,98 @@ class ProductByParty(Wizard):
         action['name'] += ' - %s (%s) @ %s' % (product.rec_name,
             product.default_uom.rec_name, date)
         return action, {}
+
+    def do_export(self, action):
+        context = Transaction().context
+        return action, {
+            'products': context.get('active_ids') or [context['active_id']],
+            'date': self.start.forecast_date,
+            }
+
+
+class ProductByPartyExport(Report):
+    'Product by Party Export'
+    __name__ = 'product.by_party.export'
+
+    @classmethod
+    def execute(cls, ids, data):
+        '''
+        Returns a CSV file with the quantity of the products per party and
+        location at the date.
+
+        The rows are read from the database with a server-side cursor and
+        no party record is instantiated.
+        '''
+        pool = Pool()
+        Date = pool.get('ir.date')
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+        Party = pool.get('party.party')
+        Product = pool.get('product.product')
+        Template = pool.get('product.template')
+        Uom = pool.get('product.uom')
+        transaction = Transaction()
+        cls.check_access()
+
+        today = Date.today()
+        date = data.get('date') or datetime.date.max
+        warehouses = Location.search([
+                ('type', '=', 'warehouse'),
+                ])
+        with transaction.set_context(
+                stock_date_end=date,
+                forecast=date > today):
+            query = Move.compute_quantities_query(
+                [w.id for w in warehouses], with_childs=True,
+                grouping=('product', 'party'),
+                grouping_filter=(data.get('products') or None,))
+
+        output = StringIO()
+        writer = csv.writer(output)
+        writer.writerow([
+                gettext('stock_external_party.export_party_code'),
+                gettext('stock_external_party.export_party'),
+                gettext('stock_external_party.export_product_code'),
+                gettext('stock_external_party.export_product'),
+                gettext('stock_external_party.export_location_code'),
+                gettext('stock_external_party.export_location'),
+                gettext('stock_external_party.export_quantity'),
+                ])
+        if query is not None:
+            party = Party.__table__()
+            product = Product.__table__()
+            template = Template.__table__()
+            location = Location.__table__()
+            query = (query
+                .join(party, condition=query.party == party.id)
+                .join(product, condition=query.product == product.id)
+                .join(template, condition=product.template == template.id)
+                .join(location, condition=query.location == location.id)
+                .select(party.code, party.name, product.code, template.name,
+                    location.code, location.name, template.default_uom,
+                    query.quantity,
+                    where=query.party != Null,
+                    order_by=[party.name, party.id, product.code,
+                        product.id, location.name, location.id]))
+
+            if backend.name == 'postgresql':
+                cursor = transaction.connection.cursor(
+                    'product_by_party_export')
+            else:
+                cursor = transaction.connection.cursor()
+            try:
+                cursor.execute(*query)
+                uoms = {}
+                for row in cursor:
+                    uom_id, quantity = row[-2:]
+                    if uom_id not in uoms:
+                        uoms[uom_id] = Uom(uom_id)
+                    quantity = uoms[uom_id].round(quantity)
+                    if not quantity:
+                        continue
+                    writer.writerow(list(row[:-2]) + [quantity])
+            finally:
+                cursor.close()
+
+        return ('csv', output.getvalue().encode('utf-8'), False,
+            'Product by Party')
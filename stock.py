@@ -1,52 +1,339 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
-from trytond.model import ModelSQL, ModelView, fields
+import datetime
+import logging
+import time
+from collections import defaultdict
+
+from sql import (Cast, Column, Conflict, For, Literal, Null, Select, Union,
+    Values, Window)
+from sql.aggregate import Max, Sum
+from sql.conditionals import Coalesce
+from sql.functions import CurrentTimestamp, Round, RowNumber
+from sql.operators import Concat
+
+from trytond import backend
+from trytond.cache import Cache
+from trytond.config import config
+from trytond.model import ModelSQL, ModelView, Unique, fields
 from trytond.pool import Pool, PoolMeta
+from trytond.pyson import Eval
+from trytond.rpc import RPC
+from trytond.tools import reduce_ids, grouped_slice
 from trytond.transaction import Transaction
 from trytond.modules.stock.move import STATES, DEPENDS
 from trytond.modules.stock import StockMixin
+from trytond.modules.stock.exceptions import PeriodCloseError
 from trytond.i18n import gettext
 from trytond.exceptions import UserError
 
+logger = logging.getLogger(__name__)
+stats_logger = logging.getLogger(__name__ + '.quantity_stats')
+# Maximum number of balances returned by a call to fetch_quantities
+FETCH_QUANTITIES_LIMIT = config.getint(
+    'stock_external_party', 'fetch_quantities_limit', default=10000)
+# Counters of the quantity computations of the process per grouping
+_quantity_stats = defaultdict(lambda: {'calls': 0, 'rows': 0, 'time': 0.0})
+
 
 class Party(StockMixin, metaclass=PoolMeta):
     __name__ = 'party.party'
-    quantity = fields.Function(fields.Float('Quantity'), 'get_quantity',
+    quantity = fields.Function(fields.Float('Quantity'), 'get_quantities',
         searcher='search_quantity')
     forecast_quantity = fields.Function(fields.Float('Forecast Quantity'),
-        'get_quantity', searcher='search_quantity')
+        'get_quantities', searcher='search_quantity')
+    quantity_computed_at = fields.Function(
+        fields.Timestamp('Quantities Computed At'),
+        'get_quantity_computed_at')
+    _quantity_cache = Cache('party.party.get_quantity',
+        size_limit=config.getint('cache', 'party_quantity', default=1024),
+        duration=config.getint('cache', 'party_quantity_duration',
+            default=60),
+        context=False)
+    _quantity_locations_cache = Cache('party.party.quantity_locations',
+        context=False)
+
+    @classmethod
+    def view_attributes(cls):
+        pool = Pool()
+        Snapshot = pool.get('stock.party.quantity.snapshot')
+        return super(Party, cls).view_attributes() + [
+            ('/tree/field[@name="quantity_computed_at"]',
+                'tree_invisible', not Snapshot.enabled()),
+            ]
+
+    @classmethod
+    def clear_quantity_cache(cls):
+        cls._quantity_cache.clear()
+        cls._quantity_locations_cache.clear()
+
+    @classmethod
+    def _get_quantity_locations(cls):
+        '''
+        Returns the ids of the locations used to compute the quantities of the
+        parties and if their children must be included.
+
+        By default all the warehouses or, if stock_party_locations_only is in
+        the context, the storage locations where moves with party have been
+        done.
+        '''
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+        context = Transaction().context
+        if context.get('locations'):
+            location_ids = list(context['locations'])
+            return location_ids, context.get('with_childs',
+                len(location_ids) == 1)
+
+        owned_only = bool(context.get('stock_party_locations_only'))
+        key = (context.get('company'), owned_only)
+        location_ids = cls._quantity_locations_cache.get(key)
+        if location_ids is None:
+            if owned_only:
+                move = Move.__table__()
+                location = Location.__table__()
+                cursor = Transaction().connection.cursor()
+                cursor.execute(*move.join(location,
+                        condition=move.to_location == location.id
+                        ).select(location.id,
+                        where=(move.party != Null)
+                        & (location.type == 'storage'),
+                        group_by=[location.id]))
+                location_ids = [l for l, in cursor]
+            else:
+                warehouses = Location.search([
+                        ('type', '=', 'warehouse')
+                        ])
+                location_ids = [x.id for x in warehouses]
+            cls._quantity_locations_cache.set(key, location_ids)
+        if owned_only:
+            return location_ids, False
+        # The stock is in the children of the warehouses
+        return location_ids, context.get('with_childs', True)
+
+    @classmethod
+    def _quantity_key(cls, name):
+        '''
+        Returns a key identifying the computation of the quantity field name
+        in the current context. Fields with the same key have the same value.
+        '''
+        pool = Pool()
+        Date = pool.get('ir.date')
+        PartyBalance = pool.get('stock.party.balance')
+        today = Date.today()
+        with Transaction().set_context(cls._quantity_context(name)):
+            context = Transaction().context
+            stock_date_end = context.get('stock_date_end') or datetime.date.max
+            future = not (stock_date_end < today
+                or (stock_date_end == today and not context.get('forecast')))
+            balance = name == 'quantity' and PartyBalance.usable()
+            return (balance, stock_date_end, future,
+                context.get('stock_date_start'),
+                bool(context.get('stock_assign')),
+                tuple(context.get('stock_destinations') or ()),
+                bool(context.get('stock_skip_warehouse')))
 
     @classmethod
     def get_quantity(cls, parties, name):
+        return cls.get_quantities(parties, [name])[name]
+
+    @classmethod
+    def get_quantities(cls, parties, names):
+        '''
+        Returns the quantities of the fields names of the parties computing
+        once the fields that share the same key.
+        '''
         pool = Pool()
         Product = pool.get('product.product')
-        Location = pool.get('stock.location')
+        PartyBalance = pool.get('stock.party.balance')
+        Snapshot = pool.get('stock.party.quantity.snapshot')
         transaction = Transaction()
         context = transaction.context
-        location_ids = context.get('locations')
-        if not location_ids:
-            warehouses = Location.search([
-                    ('type', '=', 'warehouse')
-                    ])
-            location_ids = [x.id for x in warehouses]
+        if Snapshot.usable():
+            return Snapshot.get_quantities(parties, names)
+        location_ids, with_childs = cls._get_quantity_locations()
         product_ids = None
         if context.get('products'):
             product_ids =[x.id for x in Product.browse(context.get('products'))]
+        party_ids = [p.id for p in parties]
+
+        result = {}
+        computed = {}
+        for name in names:
+            key = cls._quantity_key(name)
+            if key not in computed:
+                cache_key = (tuple(party_ids), tuple(location_ids),
+                    tuple(product_ids or ()), with_childs,
+                    context.get('company')) + key
+                quantities = cls._quantity_cache.get(cache_key)
+                if quantities is None:
+                    if key[0]:
+                        quantities = PartyBalance.get_quantities(party_ids,
+                            location_ids, product_ids=product_ids,
+                            with_childs=with_childs)
+                    else:
+                        quantities = cls._compute_quantity(parties, name,
+                            location_ids, with_childs, product_ids)
+                    cls._quantity_cache.set(cache_key, quantities)
+                computed[key] = quantities
+            result[name] = computed[key]
+        return result
+
+    @classmethod
+    def get_quantity_computed_at(cls, parties, name):
+        pool = Pool()
+        Snapshot = pool.get('stock.party.quantity.snapshot')
+        if not Snapshot.usable():
+            return dict.fromkeys([p.id for p in parties])
+        return Snapshot.get_quantities(parties, [name])[name]
+
+    @classmethod
+    def compute_quantity_snapshots(cls, parties):
+        '''
+        Stores the current quantities of the parties for the company of the
+        context.
+        '''
+        pool = Pool()
+        Snapshot = pool.get('stock.party.quantity.snapshot')
+        transaction = Transaction()
+        company_id = transaction.context.get('company')
+        party_ids = [p.id for p in parties]
+
+        with transaction.set_context(_party_quantity_snapshot=True):
+            quantities = cls.get_quantities(parties,
+                ['quantity', 'forecast_quantity'])
+        Snapshot.delete(Snapshot.search([
+                    ('company', '=', company_id),
+                    ('party', 'in', party_ids),
+                    ]))
+        now = datetime.datetime.now()
+        Snapshot.create([{
+                    'company': company_id,
+                    'party': party_id,
+                    'quantity': quantities['quantity'][party_id],
+                    'forecast_quantity': (
+                        quantities['forecast_quantity'][party_id]),
+                    'computed_at': now,
+                    } for party_id in party_ids])
 
-        pbl = cls._get_quantity(parties, name, list(location_ids),
-            grouping=('product', 'party',), grouping_filter=(product_ids,))
-        return pbl
+    @classmethod
+    def _compute_quantity(cls, parties, name, location_ids, with_childs,
+            product_ids=None):
+        '''
+        Computes the quantities of the parties from the moves only for the
+        products that may have stock of a party.
+        '''
+        pool = Pool()
+        Product = pool.get('product.product')
+        owner_product_ids = Product.get_owner_products()
+        if product_ids is None:
+            product_ids = sorted(owner_product_ids)
+        else:
+            product_ids = [p for p in product_ids if p in owner_product_ids]
+        if not product_ids:
+            return dict.fromkeys([p.id for p in parties], 0.0)
+        with Transaction().set_context(with_childs=with_childs):
+            return cls._get_quantity(parties, name, location_ids,
+                grouping=('product', 'party',),
+                grouping_filter=(product_ids,))
 
     @classmethod
     def search_quantity(cls, name, domain=None):
-        location_ids = Transaction().context.get('locations')
-        return cls._search_quantity(name, location_ids, domain,
-            grouping=('product', 'party_used'))
+        pool = Pool()
+        Move = pool.get('stock.move')
+        Product = pool.get('product.product')
+        Uom = pool.get('product.uom')
+        uom = Uom.__table__()
+        context = Transaction().context
+
+        if not domain:
+            return []
+        _, operator_, operand = domain
+        # Use the same locations as get_quantity so the search matches the
+        # displayed quantities
+        location_ids, with_childs = cls._get_quantity_locations()
+        if not location_ids:
+            return []
+        product_ids = context.get('products') or None
+        owner_product_ids = Product.get_owner_products()
+        if owner_product_ids:
+            if product_ids is None:
+                product_ids = sorted(owner_product_ids)
+            else:
+                product_ids = [p for p in product_ids
+                    if p in owner_product_ids] or [-1]
+
+        with Transaction().set_context(cls._quantity_context(name)):
+            query = Move.compute_quantities_query(location_ids, with_childs,
+                grouping=('product', 'party'), grouping_filter=(product_ids,))
+        # The comparison is done by the database on the quantity of each
+        # party summed over all products and locations, rounded like
+        # StockMixin._search_quantity.
+        Operator = fields.SQL_OPERATORS[operator_]
+        quantity = Round(
+            fields.Numeric('quantity').sql_cast(Sum(query.quantity)),
+            uom.select(Max(uom.digits)))
+        return [('id', 'in', query.select(query.party,
+                    where=query.party != Null,
+                    group_by=[query.party],
+                    having=Operator(quantity, operand)))]
+
+    @classmethod
+    def quantities_at(cls, date, parties, products=None, locations=None):
+        '''
+        Returns the quantities of the parties at the end of the date as a
+        dictionary with (location id, product id, party id) as key.
+
+        The quantities start from the party cache of the latest closed period
+        before the date and only the moves after it are added.
+        If no locations are given, the default locations are used.
+        '''
+        pool = Pool()
+        Product = pool.get('product.product')
+        transaction = Transaction()
+
+        context = {}
+        if locations is not None:
+            context['locations'] = [l.id for l in locations]
+        with transaction.set_context(context):
+            location_ids, with_childs = cls._get_quantity_locations()
+        if not location_ids:
+            return {}
+        product_ids = [p.id for p in products] if products else None
+        party_ids = [p.id for p in parties]
+        with transaction.set_context(stock_date_end=date, forecast=False,
+                stock_date_start=None, stock_assign=False):
+            return Product.products_by_location(location_ids,
+                with_childs=with_childs, grouping=('product', 'party'),
+                grouping_filter=(product_ids, party_ids))
 
 
 class Location(metaclass=PoolMeta):
     __name__ = 'stock.location'
 
+    @classmethod
+    def create(cls, vlist):
+        pool = Pool()
+        Party = pool.get('party.party')
+        locations = super(Location, cls).create(vlist)
+        Party.clear_quantity_cache()
+        return locations
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Party = pool.get('party.party')
+        super(Location, cls).write(*args)
+        Party.clear_quantity_cache()
+
+    @classmethod
+    def delete(cls, locations):
+        pool = Pool()
+        Party = pool.get('party.party')
+        super(Location, cls).delete(locations)
+        Party.clear_quantity_cache()
+
     @classmethod
     def get_cost_value(cls, locations, name):
         with Transaction().set_context(exclude_party_quantities=True):
@@ -72,7 +359,33 @@ class Move(metaclass=PoolMeta):
             searcher='search_party_used')
     party_to_check = fields.Function(fields.Many2One('party.party', 'Party'),
         'get_party_to_check')
+    party_available_quantity = fields.Function(fields.Float(
+            'Party Available Quantity', digits=(16, Eval('unit_digits', 2)),
+            states={
+                'invisible': ~Eval('party'),
+                },
+            depends=['unit_digits', 'party']),
+        'get_party_available_quantity')
 
+    @classmethod
+    def __setup__(cls):
+        super(Move, cls).__setup__()
+        # Shipment model name to field storing the party to check
+        cls._shipment_party_fields = {}
+
+    @classmethod
+    def __register__(cls, module_name):
+        sql_table = cls.__table__()
+
+        super(Move, cls).__register__(module_name)
+        table = cls.__table_handler__(module_name)
+
+        # Partial indexes for owner-scoped quantities as most of the moves
+        # have no party
+        for location in ['to_location', 'from_location']:
+            table.index_action(
+                ['party', 'product', location, 'effective_date'],
+                action='add', where=sql_table.party != Null)
 
     @fields.depends('party')
     def on_change_with_party_used(self, name=None):
@@ -87,7 +400,62 @@ class Move(metaclass=PoolMeta):
     def search_party_used(cls, name, clause):
         return [('party',) + tuple(clause[1:])]
 
-    def get_party_to_check(self, name):
+    @fields.depends('party', 'product', 'from_location', 'uom', 'company',
+        'state')
+    def on_change_with_party_available_quantity(self, name=None):
+        return self.party_availability([self])[0]
+
+    @classmethod
+    def get_party_available_quantity(cls, moves, name):
+        return dict(zip([m.id for m in moves], cls.party_availability(moves)))
+
+    @classmethod
+    def party_availability(cls, moves):
+        '''
+        Returns the list of the quantities of the party of each move available
+        today in its from location, in the unit of the move.
+
+        The quantities are computed in one query per company. Moves not in
+        staging or draft state or without party, product or from location get
+        None.
+        '''
+        pool = Pool()
+        Product = pool.get('product.product')
+        Uom = pool.get('product.uom')
+        Date = pool.get('ir.date')
+        transaction = Transaction()
+
+        result = [None] * len(moves)
+        company_moves = defaultdict(list)
+        for i, move in enumerate(moves):
+            if move.state not in {None, 'staging', 'draft'}:
+                continue
+            if move.party and move.product and move.from_location:
+                company = move.company or transaction.context.get('company')
+                company_moves[getattr(company, 'id', company)].append(
+                    (i, move))
+        for company_id, indexed_moves in company_moves.items():
+            location_ids = list({m.from_location.id for _, m in indexed_moves})
+            product_ids = list({m.product.id for _, m in indexed_moves})
+            party_ids = list({m.party.id for _, m in indexed_moves})
+            with transaction.set_context(company=company_id):
+                today = Date.today()
+            with transaction.set_context(company=company_id,
+                    stock_date_end=today, stock_assign=True, forecast=False):
+                pbl = Product.products_by_location(location_ids,
+                    with_childs=True, grouping=('product', 'party'),
+                    grouping_filter=(product_ids, party_ids))
+            for i, move in indexed_moves:
+                quantity = pbl.get((move.from_location.id, move.product.id,
+                        move.party.id), 0)
+                if move.uom and move.uom != move.product.default_uom:
+                    quantity = Uom.compute_qty(move.product.default_uom,
+                        quantity, move.uom)
+                result[i] = quantity
+        return result
+
+    @classmethod
+    def get_party_to_check(cls, moves, name):
         '''
         Returns the party to check if it\'s the same as the party used in
         the move when making the move.
@@ -95,13 +463,40 @@ class Move(metaclass=PoolMeta):
         By default it returns the party of the shipment of the move.
         If no shipment an error is raised.
         '''
-        if not self.shipment:
-            raise UserError(gettext(
-                'stock_external_party.required_shipment',
-                move=self.rec_name))
-        for name in ('customer', 'supplier', 'party'):
-            if hasattr(self.shipment, name):
-                return getattr(self.shipment, name).id
+        pool = Pool()
+        cursor = Transaction().connection.cursor()
+
+        result = dict.fromkeys([m.id for m in moves])
+        shipment_moves = defaultdict(lambda: defaultdict(list))
+        for move in moves:
+            if not move.shipment:
+                raise UserError(gettext(
+                    'stock_external_party.required_shipment',
+                    move=move.rec_name))
+            shipment_moves[move.shipment.__name__][move.shipment.id].append(
+                move.id)
+
+        for model, moves_by_shipment in shipment_moves.items():
+            Shipment = pool.get(model)
+            field = cls._get_shipment_party_field(Shipment)
+            if not field:
+                continue
+            shipment_ids = list(moves_by_shipment.keys())
+            if isinstance(Shipment._fields[field], fields.Function):
+                values = ((s['id'], s[field])
+                    for s in Shipment.read(shipment_ids, [field]))
+            else:
+                table = Shipment.__table__()
+                values = []
+                for sub_ids in grouped_slice(shipment_ids):
+                    cursor.execute(*table.select(
+                            table.id, Column(table, field),
+                            where=reduce_ids(table.id, list(sub_ids))))
+                    values.extend(cursor)
+            for shipment_id, party_id in values:
+                for move_id in moves_by_shipment[shipment_id]:
+                    result[move_id] = party_id
+        return result
 
     @classmethod
     def location_types_to_check_party(cls):
@@ -113,86 +508,434 @@ class Move(metaclass=PoolMeta):
 
     @classmethod
     def assign_try(cls, moves, with_childs=True, grouping=('product',)):
-        for move in moves:
-            if move.state != 'draft':
-                continue
-            move._check_party()
+        pool = Pool()
+        Product = pool.get('product.product')
+        cls._check_parties([m for m in moves if m.state == 'draft'])
 
-        if 'party' not in grouping:
-            grouping = grouping + ('party',)
-        return super(Move, cls).assign_try(moves, with_childs=with_childs,
-            grouping=grouping)
+        party_grouping = grouping
+        if 'party' not in party_grouping:
+            party_grouping = party_grouping + ('party',)
+
+        # Products that can not have stock of a party do not need to be
+        # grouped by party
+        owner_product_ids = Product.get_owner_products()
+        plain = [m for m in moves
+            if not m.party and m.product.id not in owner_product_ids]
+        others = [m for m in moves
+            if not m.party and m.product.id in owner_product_ids]
+        # Moves with party only need the quantities and the locks of their
+        # parties and they are assigned in a stable order so concurrent
+        # assignations of different parties do not wait for each other.
+        owned = sorted((m for m in moves if m.party),
+            key=lambda m: (m.party.id, m.product.id, m.id))
+        success = True
+        # Moves with party are assigned first because the moves without party
+        # may take the stock of any party
+        if owned:
+            party_ids = sorted({m.party.id for m in owned})
+            with Transaction().set_context(_stock_assign_parties=party_ids):
+                success &= super(Move, cls).assign_try(owned,
+                    with_childs=with_childs, grouping=party_grouping)
+        if others:
+            success &= super(Move, cls).assign_try(others,
+                with_childs=with_childs, grouping=party_grouping)
+        if plain:
+            success &= super(Move, cls).assign_try(plain,
+                with_childs=with_childs, grouping=grouping)
+        return success
+
+    @classmethod
+    def _assign_try_lock(
+            cls, product_ids, location_ids, company_ids, date, grouping):
+        pool = Pool()
+        Period = pool.get('stock.period')
+        transaction = Transaction()
+        database = transaction.database
+        connection = transaction.connection
+
+        party_ids = transaction.context.get('_stock_assign_parties')
+        if not party_ids or not database.has_select_for():
+            return super(Move, cls)._assign_try_lock(product_ids,
+                location_ids, company_ids, date, grouping)
+
+        # Lock only the moves of the parties
+        count = database.IN_MAX // 2
+        PeriodCache = Period.get_cache(grouping)
+        with connection.cursor() as cursor:
+            for company_id in company_ids:
+                period = None
+                if PeriodCache:
+                    periods = Period.search([
+                            ('date', '<', date),
+                            ('company', '=', company_id),
+                            ('state', '=', 'closed'),
+                            ], order=[('date', 'DESC')], limit=1)
+                    if periods:
+                        period, = periods
+                for sub_location_ids in grouped_slice(location_ids, count):
+                    sub_location_ids = list(sub_location_ids)
+                    table = cls.__table__()
+                    query = table.select(Literal(1),
+                        where=(reduce_ids(table.to_location, sub_location_ids)
+                            | reduce_ids(
+                                table.from_location, sub_location_ids))
+                        & table.product.in_(product_ids)
+                        & table.party.in_(party_ids)
+                        & (table.company == company_id),
+                        order_by=[table.id],
+                        for_=For('UPDATE', nowait=True))
+                    if period:
+                        query.where &= Coalesce(
+                            table.effective_date,
+                            table.planned_date,
+                            datetime.date.max) > period.date
+                    cursor.execute(*query)
 
     @classmethod
     def do(cls, moves):
-        for move in moves:
-            move._check_party()
+        pool = Pool()
+        PartyBalance = pool.get('stock.party.balance')
+        cls._check_parties(moves)
+        to_balance = [m for m in moves if m.state != 'done'
+            and (m.state, 'done') in cls._transitions]
         super(Move, cls).do(moves)
+        PartyBalance.update_moves(to_balance)
 
-    def _check_party(self):
-        types_to_check = self.location_types_to_check_party()
-        wh_output = (getattr(self.shipment, 'warehouse_output', None)
-            if self.shipment else None)
-        if not (self.to_location.type in types_to_check
-                or wh_output and self.to_location == wh_output):
+    @classmethod
+    def cancel(cls, moves):
+        pool = Pool()
+        PartyBalance = pool.get('stock.party.balance')
+        to_balance = [m for m in moves if m.state == 'done'
+            and ('done', 'cancelled') in cls._transitions]
+        super(Move, cls).cancel(moves)
+        PartyBalance.update_moves(to_balance, sign=-1)
+
+    @classmethod
+    def draft(cls, moves):
+        pool = Pool()
+        PartyBalance = pool.get('stock.party.balance')
+        to_balance = [m for m in moves if m.state == 'done'
+            and ('done', 'draft') in cls._transitions]
+        super(Move, cls).draft(moves)
+        PartyBalance.update_moves(to_balance, sign=-1)
+
+    @classmethod
+    def _party_quantity_fields(cls):
+        '''
+        Returns the fields that change the quantities of the parties when
+        written on a move with party.
+        '''
+        return {'state', 'party', 'product', 'uom', 'quantity',
+            'internal_quantity', 'from_location', 'to_location',
+            'effective_date', 'planned_date', 'company'}
+
+    @classmethod
+    def create(cls, vlist):
+        pool = Pool()
+        Party = pool.get('party.party')
+        Product = pool.get('product.product')
+        moves = super(Move, cls).create(vlist)
+        if any(v.get('party') or v.get('party_used') for v in vlist):
+            Product.add_owner_products(
+                {m.product.id for m in moves if m.party})
+            Party.clear_quantity_cache()
+        return moves
+
+    @classmethod
+    def write(cls, *args):
+        pool = Pool()
+        Party = pool.get('party.party')
+        Product = pool.get('product.product')
+        PartyBalance = pool.get('stock.party.balance')
+        to_balance = {}
+        to_check = {}
+        clear_cache = False
+        quantity_fields = cls._party_quantity_fields()
+        actions = iter(args)
+        for moves, values in zip(actions, actions):
+            if 'party' in values:
+                to_balance.update((m, None) for m in moves
+                    if m.state == 'done')
+            if values.get('party') or 'product' in values:
+                to_check.update((m.id, None) for m in moves)
+            if (not clear_cache and quantity_fields & set(values)
+                    and ('party' in values or any(m.party for m in moves))):
+                clear_cache = True
+        to_balance = list(to_balance)
+        if to_balance:
+            PartyBalance.update_moves(to_balance, sign=-1)
+        super(Move, cls).write(*args)
+        if to_balance:
+            PartyBalance.update_moves(
+                cls.browse([m.id for m in to_balance]))
+        if to_check:
+            Product.add_owner_products({m.product.id
+                    for m in cls.browse(list(to_check)) if m.party})
+        if clear_cache:
+            Party.clear_quantity_cache()
+
+    @classmethod
+    def delete(cls, moves):
+        pool = Pool()
+        Party = pool.get('party.party')
+        clear_cache = any(m.party for m in moves)
+        super(Move, cls).delete(moves)
+        if clear_cache:
+            Party.clear_quantity_cache()
+
+    @classmethod
+    def set_shipment_party(cls, shipments, clear=False):
+        '''
+        Sets the party of the shipments to their moves, or removes it if clear
+        is True, with an UPDATE per shipment model.
+        '''
+        pool = Pool()
+        Party = pool.get('party.party')
+        Product = pool.get('product.product')
+        PartyBalance = pool.get('stock.party.balance')
+        move = cls.__table__()
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        if not shipments:
             return
-        if (self.party_used and self.party_to_check
-                and self.party_used != self.party_to_check):
-            raise UserError(gettext('stock_external_party.diferent_party',
-                move=self.rec_name,
-                party=self.party_used.rec_name,
-                send_party=(self.party_to_check.rec_name if self.party_to_check
-                    else 'none')))
+        shipment_ids = defaultdict(list)
+        for shipment in shipments:
+            shipment_ids[shipment.__name__].append(shipment.id)
+
+        done_moves = cls.search([
+                ('shipment', 'in', [str(s) for s in shipments]),
+                ('state', '=', 'done'),
+                ], order=[])
+        if done_moves:
+            PartyBalance.update_moves(done_moves, sign=-1)
+
+        columns = [move.party, move.write_uid, move.write_date]
+        for model, ids in shipment_ids.items():
+            Shipment = pool.get(model)
+            field = cls._get_shipment_party_field(Shipment)
+            if not clear and not field:
+                continue
+            if (not clear
+                    and isinstance(Shipment._fields[field], fields.Function)):
+                # The party is not stored so it is read and the moves are
+                # updated per party
+                party_shipments = defaultdict(list)
+                for values in Shipment.read(ids, [field]):
+                    party_shipments[values[field]].append(values['id'])
+                for party_id, party_shipment_ids in party_shipments.items():
+                    for sub_ids in grouped_slice(party_shipment_ids):
+                        references = ['%s,%s' % (model, i) for i in sub_ids]
+                        cursor.execute(*move.update(columns,
+                                [party_id, transaction.user,
+                                    CurrentTimestamp()],
+                                where=move.shipment.in_(references)))
+                continue
+            shipment = Shipment.__table__()
+            for sub_ids in grouped_slice(ids):
+                sub_ids = list(sub_ids)
+                references = ['%s,%s' % (model, i) for i in sub_ids]
+                if clear:
+                    query = move.update(columns,
+                        [Null, transaction.user, CurrentTimestamp()],
+                        where=move.shipment.in_(references))
+                elif backend.name == 'postgresql':
+                    query = move.update(columns,
+                        [Column(shipment, field), transaction.user,
+                            CurrentTimestamp()],
+                        from_=[shipment],
+                        where=(move.shipment
+                            == Concat(model + ',', shipment.id))
+                        & reduce_ids(shipment.id, sub_ids)
+                        & move.shipment.in_(references))
+                else:
+                    # The shipments are restricted by id to use their primary
+                    # key
+                    value = shipment.select(Column(shipment, field),
+                        where=reduce_ids(shipment.id, sub_ids)
+                        & (Concat(model + ',', shipment.id)
+                            == move.shipment))
+                    query = move.update(columns,
+                        [value, transaction.user, CurrentTimestamp()],
+                        where=move.shipment.in_(references))
+                cursor.execute(*query)
+        # Invalidate the records read before the update
+        transaction.counter += 1
+
+        if done_moves:
+            PartyBalance.update_moves(
+                cls.browse([m.id for m in done_moves]))
+        if not clear:
+            Product.add_owner_products({m.product.id
+                    for m in cls.search([
+                            ('shipment', 'in', [str(s) for s in shipments]),
+                            ('party', '!=', None),
+                            ], order=[])})
+        Party.clear_quantity_cache()
+
+    def _check_party(self):
+        self._check_parties([self])
+
+    @classmethod
+    def _get_shipment_party_field(cls, Shipment):
+        '''
+        Returns the name of the field of the shipment model that stores the
+        party to check.
+        '''
+        if Shipment.__name__ not in cls._shipment_party_fields:
+            field = None
+            for name in ('customer', 'supplier', 'party'):
+                if name in Shipment._fields:
+                    field = name
+                    break
+            cls._shipment_party_fields[Shipment.__name__] = field
+        return cls._shipment_party_fields[Shipment.__name__]
+
+    @classmethod
+    def _check_parties(cls, moves):
+        '''
+        Checks that the moves with party sent to a location to check are sent
+        to the same party as their shipment.
+
+        The values are read in batch and the error is raised for the first
+        wrong move.
+        '''
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Party = pool.get('party.party')
+        move = cls.__table__()
+        location = Location.__table__()
+        cursor = Transaction().connection.cursor()
+
+        types_to_check = cls.location_types_to_check_party()
+        move_ids = [m.id for m in moves if m.id is not None and m.id >= 0]
+
+        values = {}
+        for sub_ids in grouped_slice(move_ids):
+            cursor.execute(*move.join(location,
+                    condition=move.to_location == location.id
+                    ).select(move.id, move.party, move.shipment,
+                    move.to_location, location.type,
+                    where=reduce_ids(move.id, list(sub_ids))
+                    & (move.party != Null)))
+            for move_id, party_id, shipment, to_location, type_ in cursor:
+                if shipment:
+                    model, shipment_id = shipment.split(',')
+                    shipment = (model, int(shipment_id))
+                    if shipment[1] < 0:
+                        shipment = None
+                values[move_id] = (party_id, shipment, to_location, type_)
+
+        shipment_ids = defaultdict(set)
+        for _, shipment, _, _ in values.values():
+            if shipment:
+                shipment_ids[shipment[0]].add(shipment[1])
+        shipments = {}
+        for model, ids in shipment_ids.items():
+            Shipment = pool.get(model)
+            party_field = cls._get_shipment_party_field(Shipment)
+            fnames = [f for f in ('warehouse_output', party_field)
+                if f in Shipment._fields]
+            for shipment in Shipment.read(list(ids), fnames):
+                shipments[(model, shipment['id'])] = (
+                    shipment.get('warehouse_output'),
+                    shipment.get(party_field))
+
+        for record in moves:
+            if record.id not in values:
+                continue
+            party_id, shipment, to_location, type_ = values[record.id]
+            wh_output, send_party_id = shipments.get(shipment, (None, None))
+            if not (type_ in types_to_check
+                    or wh_output and to_location == wh_output):
+                continue
+            if not shipment:
+                raise UserError(gettext(
+                        'stock_external_party.required_shipment',
+                        move=record.rec_name))
+            if send_party_id and party_id != send_party_id:
+                raise UserError(gettext('stock_external_party.diferent_party',
+                        move=record.rec_name,
+                        party=Party(party_id).rec_name,
+                        send_party=Party(send_party_id).rec_name))
 
     @classmethod
     def compute_quantities_query(cls, location_ids, with_childs=False,
             grouping=('product',), grouping_filter=None):
         context = Transaction().context
+        if 'party' in grouping:
+            party_ids = context.get('_stock_assign_parties')
+            if party_ids:
+                index = grouping.index('party')
+                grouping_filter = list(grouping_filter or [])
+                grouping_filter += [None] * (index + 1 - len(grouping_filter))
+                grouping_filter[index] = party_ids
+                grouping_filter = tuple(grouping_filter)
+            return super(Move, cls).compute_quantities_query(location_ids,
+                with_childs=with_childs, grouping=grouping,
+                grouping_filter=grouping_filter)
+        elif not context.get('exclude_party_quantities'):
+            return super(Move, cls).compute_quantities_query(location_ids,
+                with_childs=with_childs, grouping=grouping,
+                grouping_filter=grouping_filter)
 
-        new_grouping = grouping[:]
-        new_grouping_filter = (grouping_filter[:]
-            if grouping_filter is not None else None)
-        if 'party' not in grouping and context.get('exclude_party_quantities'):
-            new_grouping = grouping[:] + ('party',)
-            if grouping_filter is not None:
-                new_grouping_filter = grouping_filter[:]
-
-        query = super(Move, cls).compute_quantities_query(
-            location_ids, with_childs=with_childs, grouping=new_grouping,
-            grouping_filter=new_grouping_filter)
-        return query
+        # Group also by party to use the party period cache but only keep the
+        # quantities without party so the database returns a single row per
+        # location and grouping. As the period cache rows go through the same
+        # query, the quantities of the parties never need to be removed in
+        # Python.
+        query = super(Move, cls).compute_quantities_query(location_ids,
+            with_childs=with_childs, grouping=grouping + ('party',),
+            grouping_filter=grouping_filter)
+        if query is None:
+            return query
+        query_keys = [Column(query, key).as_(key) for key in grouping]
+        return query.select(query.location.as_('location'),
+            *query_keys, Sum(query.quantity).as_('quantity'),
+            where=query.party == Null,
+            group_by=[query.location] + [Column(query, key)
+                for key in grouping])
 
     @classmethod
     def compute_quantities(cls, query, location_ids, with_childs=False,
             grouping=('product',), grouping_filter=None):
+        if not config.getboolean(
+                'stock_external_party', 'quantity_stats', default=False):
+            return super(Move, cls).compute_quantities(query, location_ids,
+                with_childs=with_childs, grouping=grouping,
+                grouping_filter=grouping_filter)
 
         context = Transaction().context
-
-        new_grouping = grouping[:]
-        new_grouping_filter = (grouping_filter[:]
-            if grouping_filter is not None else None)
-        remove_party_grouping = False
-        if 'party' not in grouping and context.get('exclude_party_quantities'):
-            new_grouping = grouping[:] + ('party',)
-            if grouping_filter is not None:
-                new_grouping_filter = grouping_filter[:]
-            remove_party_grouping = True
-
+        start = time.perf_counter()
         quantities = super(Move, cls).compute_quantities(query, location_ids,
-            with_childs=with_childs, grouping=new_grouping,
-            grouping_filter=new_grouping_filter)
-
-        if remove_party_grouping:
-            new_quantities = {}
-            for key, quantity in quantities.items():
-                new_quantities.setdefault(key[:-1], 0.)
-                if key[-1] is not None:
-                    # party quantity. ignore
-                    continue
-                new_quantities[key[:-1]] += quantity
-            quantities = new_quantities
+            with_childs=with_childs, grouping=grouping,
+            grouping_filter=grouping_filter)
+        duration = time.perf_counter() - start
+
+        exclude_party = bool('party' not in grouping
+            and context.get('exclude_party_quantities'))
+        stats = _quantity_stats[(grouping, exclude_party)]
+        stats['calls'] += 1
+        stats['rows'] += len(quantities)
+        stats['time'] += duration
+        stats_logger.info(
+            'grouping=%s exclude_party=%s locations=%s with_childs=%s '
+            'rows=%s time=%.6f',
+            ','.join(grouping), exclude_party, len(location_ids), with_childs,
+            len(quantities), duration)
         return quantities
 
+    @staticmethod
+    def quantity_stats():
+        '''
+        Returns the counters of calls, rows and time of the quantity
+        computations done by the process per grouping and exclusion of the
+        party quantities.
+        It is only filled when quantity_stats is set in the
+        stock_external_party section of the configuration.
+        '''
+        return {k: dict(v) for k, v in _quantity_stats.items()}
+
 
 class ShipmentOut(metaclass=PoolMeta):
     __name__ = 'stock.shipment.out'
@@ -211,16 +954,14 @@ class ShipmentExternal(metaclass=PoolMeta):
     def draft(cls, shipments):
         pool = Pool()
         Move = pool.get('stock.move')
-        moves = list(m for s in shipments for m in s.moves)
-        Move.write(moves, {'party_used': None})
+        Move.set_shipment_party(shipments, clear=True)
         super(ShipmentExternal, cls).draft(shipments)
 
     @classmethod
     def wait(cls, shipments):
         pool = Pool()
         Move = pool.get('stock.move')
-        for shipment in shipments:
-            Move.write(list(shipment.moves), {'party_used': shipment.party})
+        Move.set_shipment_party(shipments)
         super(ShipmentExternal, cls).wait(shipments)
 
 
@@ -228,19 +969,221 @@ class Period(metaclass=PoolMeta):
     __name__ = 'stock.period'
     party_caches = fields.One2Many('stock.period.cache.party', 'period',
         'Party Caches', readonly=True)
+    party_caches_pruned = fields.Boolean('Party Caches Pruned', readonly=True,
+        help="The party caches have been removed because a later period "
+        "is closed.")
+    _party_caches_pruned_cache = Cache('stock.period.party_caches_pruned',
+        context=False)
+
+    @staticmethod
+    def default_party_caches_pruned():
+        return False
 
     @classmethod
     def groupings(cls):
-        return super(Period, cls).groupings() + [('product', 'party')]
+        groupings = super(Period, cls).groupings()
+        if not Transaction().context.get('_stock_period_party_caches'):
+            groupings = groupings + [('product', 'party')]
+        return groupings
+
+    @classmethod
+    def close(cls, periods):
+        pool = Pool()
+        Move = pool.get('stock.move')
+        transaction = Transaction()
+
+        # The party caches must be computed before the periods are closed so
+        # their quantities are based on the previous closed period.
+        transaction.database.lock(transaction.connection, Move._table)
+        cls.check_close(periods)
+        cls.create_party_caches([p for p in periods if p.state == 'draft'])
+        with transaction.set_context(_stock_period_party_caches=True):
+            super(Period, cls).close(periods)
+
+    @classmethod
+    def check_close(cls, periods):
+        '''
+        Raises the errors of the base close before the party caches are
+        computed.
+        '''
+        pool = Pool()
+        Move = pool.get('stock.move')
+        Date = pool.get('ir.date')
+
+        if not periods:
+            return
+        recent_date = max(p.date for p in periods)
+        if recent_date >= Date.today():
+            raise PeriodCloseError(
+                gettext('stock.msg_period_close_date'))
+        if Move.search([
+                    ('state', '=', 'assigned'),
+                    ['OR', [
+                            ('effective_date', '=', None),
+                            ('planned_date', '<=', recent_date),
+                            ],
+                        ('effective_date', '<=', recent_date),
+                        ]], limit=1, order=[]):
+            raise PeriodCloseError(
+                gettext('stock.msg_period_close_assigned_move'))
+
+    @classmethod
+    def create_party_caches(cls, periods):
+        '''
+        Fills the party caches of the periods with a single INSERT ... SELECT
+        per period computed by the database.
+        '''
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+        Product = pool.get('product.product')
+        Template = pool.get('product.template')
+        Uom = pool.get('product.uom')
+        Cache = pool.get('stock.period.cache.party')
+        cache = Cache.__table__()
+        product = Product.__table__()
+        template = Template.__table__()
+        uom = Uom.__table__()
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        with transaction.set_context(active_test=False):
+            locations = Location.search([
+                    ('type', 'not in', ['warehouse', 'view']),
+                    ], order=[])
+        location_ids = [l.id for l in locations]
+        if not location_ids:
+            return
+
+        for period in periods:
+            with transaction.set_context(
+                    stock_date_end=period.date,
+                    stock_date_start=None,
+                    stock_assign=False,
+                    forecast=False,
+                    stock_destinations=None,
+                    ):
+                query = Move.compute_quantities_query(location_ids,
+                    grouping=('product', 'party'))
+            quantity = Round(
+                fields.Numeric('quantity').sql_cast(query.quantity),
+                uom.digits)
+            query = (query
+                .join(product, condition=query.product == product.id)
+                .join(template, condition=product.template == template.id)
+                .join(uom, condition=template.default_uom == uom.id)
+                .select(
+                    Literal(transaction.user), CurrentTimestamp(),
+                    Literal(period.id), query.location, query.product,
+                    query.party, quantity,
+                    where=quantity != 0))
+            cursor.execute(*cache.insert([
+                        cache.create_uid, cache.create_date,
+                        cache.period, cache.location, cache.product,
+                        cache.party, cache.internal_quantity,
+                        ], query))
+
+    @classmethod
+    def draft(cls, periods):
+        pool = Pool()
+        Cache = pool.get('stock.period.cache.party')
+        cache = Cache.__table__()
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        for sub_periods in grouped_slice(periods):
+            cursor.execute(*cache.delete(
+                    where=reduce_ids(cache.period,
+                        [p.id for p in sub_periods])))
+        with transaction.set_context(_stock_period_party_caches=True):
+            super(Period, cls).draft(periods)
+        if any(p.party_caches_pruned for p in periods):
+            cls.write(periods, {
+                    'party_caches_pruned': False,
+                    })
+            cls._party_caches_pruned_cache.clear()
 
     @classmethod
     def get_cache(cls, grouping):
         pool = Pool()
         Cache = super(Period, cls).get_cache(grouping)
         if grouping == ('product', 'party'):
+            if cls._party_caches_pruned():
+                # Compute from the moves as the period has no cache
+                return None
             return pool.get('stock.period.cache.party')
         return Cache
 
+    @classmethod
+    def _party_caches_pruned(cls):
+        '''
+        Returns True if the period used to compute the quantities at the
+        stock_date_end of the context has its party caches pruned.
+        '''
+        pool = Pool()
+        User = pool.get('res.user')
+        context = Transaction().context
+        stock_date_end = context.get('stock_date_end')
+        if not stock_date_end or context.get('stock_date_start'):
+            return False
+        if not cls._any_party_caches_pruned():
+            return False
+        company = User(Transaction().user).company
+        periods = cls.search([
+                ('date', '<=', stock_date_end),
+                ('state', '=', 'closed'),
+                ('company', '=', company.id if company else -1),
+                ], order=[('date', 'DESC')], limit=1)
+        return bool(periods and periods[0].party_caches_pruned)
+
+    @classmethod
+    def _any_party_caches_pruned(cls):
+        'Returns True if the party caches of any period have been pruned'
+        pruned = cls._party_caches_pruned_cache.get(None)
+        if pruned is None:
+            period = cls.__table__()
+            cursor = Transaction().connection.cursor()
+            cursor.execute(*period.select(period.id,
+                    where=period.party_caches_pruned == Literal(True),
+                    limit=1))
+            pruned = bool(cursor.fetchone())
+            cls._party_caches_pruned_cache.set(None, pruned)
+        return pruned
+
+    @classmethod
+    def prune_party_caches(cls):
+        '''
+        Removes the party caches of the closed periods older than the latest
+        closed period of each company as they are superseded by it.
+
+        Quantities at a date before the latest period are then computed from
+        the moves.
+        '''
+        pool = Pool()
+        Cache = pool.get('stock.period.cache.party')
+        cache = Cache.__table__()
+        cursor = Transaction().connection.cursor()
+
+        periods = cls.search([
+                ('state', '=', 'closed'),
+                ], order=[('company', 'ASC'), ('date', 'DESC')])
+        latest = set()
+        to_prune = []
+        for period in periods:
+            if period.company not in latest:
+                latest.add(period.company)
+            elif not period.party_caches_pruned:
+                to_prune.append(period)
+        for sub_periods in grouped_slice(to_prune):
+            cursor.execute(*cache.delete(
+                    where=reduce_ids(cache.period,
+                        [p.id for p in sub_periods])))
+        if to_prune:
+            cls.write(to_prune, {
+                    'party_caches_pruned': True,
+                    })
+            cls._party_caches_pruned_cache.clear()
+
 
 class PeriodCacheParty(ModelSQL, ModelView):
     '''
@@ -260,6 +1203,614 @@ class PeriodCacheParty(ModelSQL, ModelView):
     internal_quantity = fields.Float('Internal Quantity', readonly=True)
 
 
+class PartyBalance(ModelSQL, ModelView):
+    '''
+    Stock Party Balance
+
+    It stores the done quantity of each product per location and party. It is
+    updated when moves are done, cancelled or reset to draft.
+    '''
+    __name__ = 'stock.party.balance'
+    company = fields.Many2One('company.company', 'Company', required=True,
+        readonly=True, select=True, ondelete='CASCADE')
+    location = fields.Many2One('stock.location', 'Location', required=True,
+        readonly=True, select=True, ondelete='CASCADE')
+    product = fields.Many2One('product.product', 'Product', required=True,
+        readonly=True, select=True, ondelete='CASCADE')
+    party = fields.Many2One('party.party', 'Party', required=True,
+        readonly=True, select=True, ondelete='CASCADE')
+    internal_quantity = fields.Float('Internal Quantity', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(PartyBalance, cls).__setup__()
+        t = cls.__table__()
+        cls._sql_constraints += [
+            ('balance_uniq',
+                Unique(t, t.company, t.location, t.product, t.party),
+                'stock_external_party.party_balance_unique'),
+            ]
+        cls.__rpc__.update({
+                'fetch_quantities': RPC(readonly=True),
+                })
+
+    @classmethod
+    def __register__(cls, module_name):
+        table_exist = backend.TableHandler.table_exist(cls._table)
+
+        super(PartyBalance, cls).__register__(module_name)
+        table = cls.__table_handler__(module_name)
+
+        # Index for the pagination of fetch_quantities
+        table.index_action(['party', 'product', 'location'], action='add')
+
+        # Fill the balance from the existing moves on installation
+        if not table_exist:
+            cls.rebuild()
+
+    @classmethod
+    def usable(cls):
+        '''
+        Returns True if the balance can be used to compute the quantities of
+        the current context.
+        '''
+        pool = Pool()
+        Date = pool.get('ir.date')
+        context = Transaction().context
+        if (context.get('stock_date_start')
+                or context.get('stock_assign')
+                or context.get('stock_destinations')
+                or context.get('stock_skip_warehouse')):
+            return False
+        stock_date_end = context.get('stock_date_end')
+        return not stock_date_end or stock_date_end >= Date.today()
+
+    @classmethod
+    def update_moves(cls, moves, sign=1):
+        '''
+        Adds the quantity of the moves to the balance or substracts it if sign
+        is negative.
+        '''
+        deltas = defaultdict(float)
+        for move in moves:
+            if not move.party:
+                continue
+            key = (move.company.id, move.product.id, move.party.id)
+            quantity = sign * move.internal_quantity
+            deltas[(move.to_location.id,) + key] += quantity
+            deltas[(move.from_location.id,) + key] -= quantity
+        cls._apply_deltas(deltas)
+
+    @classmethod
+    def _apply_deltas(cls, deltas):
+        pool = Pool()
+        Party = pool.get('party.party')
+        table = cls.__table__()
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        deltas = [(k, q) for k, q in deltas.items() if q]
+        if not deltas:
+            return
+        if backend.name == 'postgresql':
+            # Create the missing balances without failing on the ones created
+            # by concurrent transactions and add the quantities with a single
+            # UPDATE per slice.
+            for sub_deltas in grouped_slice(deltas):
+                sub_deltas = list(sub_deltas)
+                cursor.execute(*table.insert([
+                            table.create_uid, table.create_date,
+                            table.location, table.company, table.product,
+                            table.party, table.internal_quantity,
+                            ], [[transaction.user, CurrentTimestamp()]
+                            + list(key) + [0] for key, _ in sub_deltas],
+                        on_conflict=Conflict(table,
+                            indexed_columns=[table.company, table.location,
+                                table.product, table.party])))
+                delta = Values([list(key) + [quantity]
+                        for key, quantity in sub_deltas])
+                cursor.execute(*table.update(
+                        [table.internal_quantity, table.write_uid,
+                            table.write_date],
+                        [table.internal_quantity + delta.column5,
+                            transaction.user, CurrentTimestamp()],
+                        from_=[delta],
+                        where=(table.location == delta.column1)
+                        & (table.company == delta.column2)
+                        & (table.product == delta.column3)
+                        & (table.party == delta.column4)))
+        else:
+            # Prevent concurrent creation of the same balance
+            transaction.database.lock(transaction.connection, cls._table)
+            to_create = []
+            for key, quantity in deltas:
+                location, company, product, party = key
+                cursor.execute(*table.update(
+                        [table.internal_quantity, table.write_uid,
+                            table.write_date],
+                        [table.internal_quantity + quantity,
+                            transaction.user, CurrentTimestamp()],
+                        where=(table.location == location)
+                        & (table.company == company)
+                        & (table.product == product)
+                        & (table.party == party)))
+                if not cursor.rowcount:
+                    to_create.append({
+                            'location': location,
+                            'company': company,
+                            'product': product,
+                            'party': party,
+                            'internal_quantity': quantity,
+                            })
+            if to_create:
+                cls.create(to_create)
+        Party.clear_quantity_cache()
+
+    @classmethod
+    def get_quantities(cls, party_ids, location_ids, product_ids=None,
+            with_childs=False):
+        '''
+        Returns a dictionary with party id as key and the quantity on the
+        locations as value.
+        '''
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Product = pool.get('product.product')
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        company_id = Transaction().context.get('company')
+
+        quantities = dict.fromkeys(party_ids, 0.0)
+        if not location_ids:
+            return quantities
+
+        lines = []
+        for location_id in location_ids:
+            if with_childs:
+                location_query = Location.search([
+                        ('parent', 'child_of', [location_id]),
+                        ], query=True, order=[])
+            else:
+                location_query = [location_id]
+            for sub_party_ids in grouped_slice(party_ids):
+                where = (table.location.in_(location_query)
+                    & reduce_ids(table.party, list(sub_party_ids)))
+                if product_ids:
+                    where &= reduce_ids(table.product, product_ids)
+                if company_id:
+                    where &= table.company == company_id
+                cursor.execute(*table.select(
+                        table.party, table.product,
+                        Sum(table.internal_quantity),
+                        where=where,
+                        group_by=[table.party, table.product]))
+                lines.extend(cursor)
+
+        uoms = {p.id: p.default_uom
+            for p in Product.browse(list({l[1] for l in lines}))}
+        for party_id, product_id, quantity in lines:
+            quantities[party_id] += uoms[product_id].round(quantity)
+        return quantities
+
+    @classmethod
+    def fetch_quantities(cls, cursor=None, since=None, limit=1000):
+        '''
+        Returns a page of the balances of the company of the context as a
+        dictionary with:
+            quantities: the list of [party, product, location, quantity]
+                ordered by party, product and location.
+            cursor: the token to pass to get the next page or None if it is
+                the last one.
+
+        If since is set, only the balances changed at or after this date time
+        are returned. Only the balances of the storage locations are returned
+        and limit is capped to FETCH_QUANTITIES_LIMIT.
+        '''
+        pool = Pool()
+        Location = pool.get('stock.location')
+        Product = pool.get('product.product')
+        User = pool.get('res.user')
+        table = cls.__table__()
+        location = Location.__table__()
+        transaction = Transaction()
+        company = User(transaction.user).company
+
+        if not limit or limit > FETCH_QUANTITIES_LIMIT:
+            limit = FETCH_QUANTITIES_LIMIT
+        where = ((table.company == (company.id if company else -1))
+            & (location.type == 'storage'))
+        if cursor:
+            try:
+                party, product, location_id = map(int, cursor.split(':'))
+            except (AttributeError, ValueError):
+                raise UserError(gettext(
+                        'stock_external_party.invalid_fetch_cursor',
+                        cursor=cursor))
+            where &= ((table.party > party)
+                | ((table.party == party) & (table.product > product))
+                | ((table.party == party) & (table.product == product)
+                    & (table.location > location_id)))
+        if since:
+            where &= Coalesce(table.write_date, table.create_date) >= since
+        sql_cursor = transaction.connection.cursor()
+        sql_cursor.execute(*table.join(location,
+                condition=table.location == location.id
+                ).select(
+                table.party, table.product, table.location,
+                table.internal_quantity,
+                where=where,
+                order_by=[table.party, table.product, table.location],
+                limit=limit))
+        rows = sql_cursor.fetchall()
+
+        uoms = {p.id: p.default_uom
+            for p in Product.browse(list({r[1] for r in rows}))}
+        quantities = [[party, product, location,
+                uoms[product].round(quantity or 0)]
+            for party, product, location, quantity in rows]
+        next_cursor = None
+        if len(rows) == limit:
+            next_cursor = '%s:%s:%s' % tuple(rows[-1][:3])
+        return {
+            'quantities': quantities,
+            'cursor': next_cursor,
+            }
+
+    @classmethod
+    def compute_balances(cls):
+        '''
+        Returns a dictionary with (location, company, product, party) as key
+        and the quantity computed from the moves as value.
+        '''
+        pool = Pool()
+        Company = pool.get('company.company')
+        Location = pool.get('stock.location')
+        Product = pool.get('product.product')
+        Date = pool.get('ir.date')
+
+        with Transaction().set_context(active_test=False):
+            locations = Location.search([
+                    ('type', 'not in', ['warehouse', 'view']),
+                    ], order=[])
+        location_ids = [l.id for l in locations]
+
+        balances = {}
+        for company in Company.search([]):
+            with Transaction().set_context(company=company.id):
+                today = Date.today()
+            with Transaction().set_context(
+                    company=company.id,
+                    stock_date_end=today,
+                    stock_date_start=None,
+                    stock_assign=False,
+                    forecast=False,
+                    stock_destinations=None,
+                    ):
+                pbl = Product.products_by_location(location_ids,
+                    grouping=('product', 'party'))
+            for (location, product, party), quantity in pbl.items():
+                if party is None or not quantity:
+                    continue
+                balances[(location, company.id, product, party)] = quantity
+        return balances
+
+    @classmethod
+    def rebuild(cls):
+        '''
+        Replaces the balance by the quantities computed from the moves.
+        '''
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        cursor.execute(*table.delete())
+        to_create = []
+        for key, quantity in cls.compute_balances().items():
+            location, company, product, party = key
+            to_create.append({
+                    'location': location,
+                    'company': company,
+                    'product': product,
+                    'party': party,
+                    'internal_quantity': quantity,
+                    })
+        if to_create:
+            cls.create(to_create)
+
+    @classmethod
+    def verify(cls):
+        '''
+        Compares the balance with the quantities computed from the moves and
+        returns the list of (key, expected quantity, balance quantity) that
+        differ.
+        '''
+        pool = Pool()
+        Product = pool.get('product.product')
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+
+        expected = cls.compute_balances()
+        cursor.execute(*table.select(
+                table.location, table.company, table.product, table.party,
+                table.internal_quantity))
+        stored = {tuple(line[:-1]): line[-1] for line in cursor}
+
+        keys = set(expected) | set(stored)
+        uoms = {p.id: p.default_uom
+            for p in Product.browse(list({k[2] for k in keys}))}
+        differences = []
+        for key in sorted(keys):
+            uom = uoms[key[2]]
+            expected_quantity = uom.round(expected.get(key, 0))
+            stored_quantity = uom.round(stored.get(key) or 0)
+            if expected_quantity != stored_quantity:
+                differences.append((key, expected_quantity, stored_quantity))
+        for key, expected_quantity, stored_quantity in differences:
+            logger.warning('Party balance %s is %s instead of %s',
+                key, stored_quantity, expected_quantity)
+        return differences
+
+
+class PartyQuantitySnapshot(ModelSQL, ModelView):
+    '''
+    Stock Party Quantity Snapshot
+
+    It stores the quantities of the parties computed in background by the
+    queue. When quantity_snapshot is set in the stock_external_party section
+    of the configuration, the quantities of the parties without products nor
+    locations in the context are read from it instead of being computed.
+    '''
+    __name__ = 'stock.party.quantity.snapshot'
+    company = fields.Many2One('company.company', 'Company', required=True,
+        readonly=True, select=True, ondelete='CASCADE')
+    party = fields.Many2One('party.party', 'Party', required=True,
+        readonly=True, select=True, ondelete='CASCADE')
+    quantity = fields.Float('Quantity', readonly=True)
+    forecast_quantity = fields.Float('Forecast Quantity', readonly=True)
+    computed_at = fields.Timestamp('Computed At', readonly=True)
+
+    @staticmethod
+    def enabled():
+        'Returns True if the snapshots are enabled in the configuration'
+        return config.getboolean(
+            'stock_external_party', 'quantity_snapshot', default=False)
+
+    @classmethod
+    def usable(cls):
+        '''
+        Returns True if the quantities of the parties must be read from the
+        snapshot in the current context.
+        '''
+        context = Transaction().context
+        if not cls.enabled():
+            return False
+        return not any(context.get(k) for k in [
+                '_party_quantity_snapshot', 'products', 'locations',
+                'stock_date_start', 'stock_date_end'])
+
+    @classmethod
+    def get_quantities(cls, parties, names):
+        '''
+        Returns the values of the fields names of the snapshot of the parties
+        for the company of the context.
+        '''
+        table = cls.__table__()
+        cursor = Transaction().connection.cursor()
+        company_id = Transaction().context.get('company')
+        party_ids = [p.id for p in parties]
+
+        fnames = {
+            'quantity': 'quantity',
+            'forecast_quantity': 'forecast_quantity',
+            'quantity_computed_at': 'computed_at',
+            }
+        result = {}
+        for name in names:
+            result[name] = dict.fromkeys(party_ids,
+                None if name == 'quantity_computed_at' else 0.0)
+        for sub_ids in grouped_slice(party_ids):
+            cursor.execute(*table.select(table.party,
+                    *[Column(table, fnames[n]) for n in names],
+                    where=reduce_ids(table.party, sub_ids)
+                    & (table.company == company_id)))
+            for line in cursor:
+                for name, value in zip(names, line[1:]):
+                    result[name][line[0]] = value
+        return result
+
+    @classmethod
+    def refresh(cls):
+        '''
+        Enqueues the computation of the quantities of all the parties for each
+        company.
+        '''
+        pool = Pool()
+        Party = pool.get('party.party')
+        Company = pool.get('company.company')
+        transaction = Transaction()
+
+        parties = Party.search([])
+        for company in Company.search([]):
+            with transaction.set_context(company=company.id,
+                    queue_name='stock_party_quantity'):
+                for sub_parties in grouped_slice(parties):
+                    Party.__queue__.compute_quantity_snapshots(
+                        list(sub_parties))
+
+
+class PartyBalanceHistory(ModelSQL, ModelView):
+    '''
+    Stock Party Balance History
+
+    It shows the quantity of each product per location and party at the end of
+    each date between the from and to dates of the context, every interval
+    days.
+    '''
+    __name__ = 'stock.party.balance.history'
+
+    company = fields.Many2One('company.company', 'Company')
+    location = fields.Many2One('stock.location', 'Location')
+    product = fields.Many2One('product.product', 'Product')
+    party = fields.Many2One('party.party', 'Party')
+    date = fields.Date('Date')
+    quantity = fields.Float('Quantity')
+
+    @classmethod
+    def __setup__(cls):
+        super(PartyBalanceHistory, cls).__setup__()
+        cls._order.insert(0, ('date', 'ASC'))
+
+    @classmethod
+    def _dates(cls):
+        'Returns the dates of the history from the context'
+        pool = Pool()
+        Date = pool.get('ir.date')
+        context = Transaction().context
+        to_date = context.get('to_date') or Date.today()
+        from_date = min(context.get('from_date') or to_date, to_date)
+        interval = datetime.timedelta(
+            days=max(context.get('interval') or 1, 1))
+        dates = []
+        date = from_date
+        while date <= to_date:
+            dates.append(date)
+            date += interval
+        return dates
+
+    @classmethod
+    def table_query(cls):
+        pool = Pool()
+        Move = pool.get('stock.move')
+        Location = pool.get('stock.location')
+        Period = pool.get('stock.period')
+        PeriodCacheParty = pool.get('stock.period.cache.party')
+        move = Move.__table__()
+        cache = PeriodCacheParty.__table__()
+        context = Transaction().context
+        company_id = context.get('company', -1)
+
+        dates = cls._dates()
+        if context.get('locations'):
+            location_ids = list(context['locations'])
+        else:
+            location_ids = [l.id for l in Location.search([
+                        ('type', '=', 'warehouse'),
+                        ])]
+        locations = Location.search([
+                ('parent', 'child_of', location_ids or [-1]),
+                ('type', '=', 'storage'),
+                ], query=True, order=[])
+
+        # The quantities start from the party cache of the latest closed
+        # period before the first date
+        periods = Period.search([
+                ('date', '<', dates[0]),
+                ('company', '=', company_id),
+                ('state', '=', 'closed'),
+                ('party_caches_pruned', '=', False),
+                ], order=[('date', 'DESC')], limit=1)
+        where = ((move.state == 'done')
+            & (move.party != Null)
+            & (move.company == company_id)
+            & (move.effective_date <= dates[-1]))
+        if periods:
+            period, = periods
+            where &= move.effective_date > period.date
+        deltas = Union(
+            move.select(
+                move.to_location.as_('location'),
+                move.product.as_('product'),
+                move.party.as_('party'),
+                move.effective_date.as_('date'),
+                move.internal_quantity.as_('quantity'),
+                where=where & move.to_location.in_(locations)),
+            move.select(
+                move.from_location.as_('location'),
+                move.product.as_('product'),
+                move.party.as_('party'),
+                move.effective_date.as_('date'),
+                (-move.internal_quantity).as_('quantity'),
+                where=where & move.from_location.in_(locations)),
+            all_=True)
+        if periods:
+            deltas = Union(deltas, cache.select(
+                    cache.location.as_('location'),
+                    cache.product.as_('product'),
+                    cache.party.as_('party'),
+                    Literal(period.date).as_('date'),
+                    cache.internal_quantity.as_('quantity'),
+                    where=(cache.period == period.id)
+                    & (cache.party != Null)
+                    & cache.location.in_(locations)),
+                all_=True)
+
+        # Each date gets the quantities since the previous date
+        samples = None
+        previous = datetime.date.min
+        for date in dates:
+            sample = Select([
+                    Literal(date).as_('date'),
+                    Literal(previous).as_('previous'),
+                    ])
+            samples = sample if samples is None else samples | sample
+            previous = date
+        keys = deltas.select(
+            deltas.location, deltas.product, deltas.party,
+            group_by=[deltas.location, deltas.product, deltas.party])
+        delta = keys.join(samples, type_='CROSS').join(deltas, 'LEFT',
+            condition=(deltas.location == keys.location)
+            & (deltas.product == keys.product)
+            & (deltas.party == keys.party)
+            & (deltas.date > samples.previous)
+            & (deltas.date <= samples.date))
+        delta = delta.select(
+            keys.location, keys.product, keys.party, samples.date,
+            Coalesce(Sum(deltas.quantity), 0).as_('quantity'),
+            group_by=[keys.location, keys.product, keys.party, samples.date])
+
+        # The running sum of the quantities is the balance at each date
+        partition = [delta.location, delta.product, delta.party]
+        return delta.select(
+            RowNumber(window=Window([],
+                    order_by=partition + [delta.date])).as_('id'),
+            Literal(0).as_('create_uid'),
+            CurrentTimestamp().as_('create_date'),
+            Literal(None).as_('write_uid'),
+            Literal(None).as_('write_date'),
+            Literal(company_id).as_('company'),
+            delta.location.as_('location'),
+            delta.product.as_('product'),
+            delta.party.as_('party'),
+            cls.date.sql_cast(delta.date).as_('date'),
+            Sum(delta.quantity, window=Window(partition,
+                    order_by=[delta.date])).as_('quantity'))
+
+
+class PartyBalanceHistoryContext(ModelView):
+    'Stock Party Balance History Context'
+    __name__ = 'stock.party.balance.history.context'
+    from_date = fields.Date('From Date', required=True)
+    to_date = fields.Date('To Date', required=True)
+    interval = fields.Integer('Interval', required=True,
+        help="The number of days between two dates of the history.")
+    locations = fields.Many2Many('stock.location', None, None, 'Locations',
+        domain=[
+            ('type', 'in', ['warehouse', 'storage']),
+            ],
+        help="Leave empty for all the warehouses.")
+
+    @classmethod
+    def default_to_date(cls):
+        return Pool().get('ir.date').today()
+
+    @classmethod
+    def default_from_date(cls):
+        return cls.default_to_date() - datetime.timedelta(days=90)
+
+    @staticmethod
+    def default_interval():
+        return 1
+
+
 class Inventory(metaclass=PoolMeta):
     __name__ = 'stock.inventory'
 
@@ -267,6 +1818,140 @@ class Inventory(metaclass=PoolMeta):
     def grouping(cls):
         return super(Inventory, cls).grouping() + ('party', )
 
+    @classmethod
+    def _complete_lines_query(cls, inventory, product_ids=None):
+        '''
+        Returns the query of the quantities per product and party of the
+        inventory location.
+
+        Only the products that may have stock of a party are grouped by party,
+        the others get their quantities without party.
+        '''
+        pool = Pool()
+        Move = pool.get('stock.move')
+        Product = pool.get('product.product')
+        location_ids = [inventory.location.id]
+
+        owner_product_ids = Product.get_owner_products()
+        if product_ids is None:
+            plain_ids = owned_ids = None
+        else:
+            plain_ids = [p for p in product_ids if p not in owner_product_ids]
+            owned_ids = [p for p in product_ids if p in owner_product_ids]
+
+        queries = []
+        if plain_ids is None or plain_ids:
+            query = Move.compute_quantities_query(location_ids,
+                grouping=('product',), grouping_filter=(plain_ids,))
+            if query is not None:
+                where = None
+                if plain_ids is None and owner_product_ids:
+                    where = ~reduce_ids(
+                        query.product, sorted(owner_product_ids))
+                queries.append(query.select(
+                        query.product.as_('product'),
+                        Cast(Null, Move.party.sql_type().base).as_('party'),
+                        query.quantity.as_('quantity'),
+                        where=where))
+        if owner_product_ids and (owned_ids is None or owned_ids):
+            query = Move.compute_quantities_query(location_ids,
+                grouping=('product', 'party'),
+                grouping_filter=(owned_ids or sorted(owner_product_ids),))
+            if query is not None:
+                queries.append(query.select(
+                        query.product.as_('product'),
+                        query.party.as_('party'),
+                        query.quantity.as_('quantity')))
+        if not queries:
+            return
+        elif len(queries) == 1:
+            query, = queries
+            return query
+        return Union(*queries, all_=True)
+
+    @classmethod
+    def complete_lines(cls, inventories, fill=True):
+        pool = Pool()
+        Line = pool.get('stock.inventory.line')
+        Product = pool.get('product.product')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+
+        grouping = cls.grouping()
+        if grouping != ('product', 'party'):
+            return super(Inventory, cls).complete_lines(inventories,
+                fill=fill)
+
+        to_create, to_write, to_delete = [], [], []
+        for inventory in inventories:
+            # Once done computation is wrong because include created moves
+            if inventory.state == 'done':
+                continue
+            if fill:
+                product_ids = None
+            else:
+                product_ids = list({l.product.id for l in inventory.lines})
+            with transaction.set_context(
+                    company=inventory.company.id,
+                    stock_date_end=inventory.date):
+                query = cls._complete_lines_query(inventory, product_ids)
+
+            # Match the quantities with the existing lines in the same query
+            quantities, missing = {}, []
+            if query is not None:
+                line = Line.__table__()
+                lines = line.select(line.id, line.product, line.party,
+                    where=line.inventory == inventory.id)
+                join = query.join(lines, 'LEFT',
+                    condition=(lines.product == query.product)
+                    & ((lines.party == query.party)
+                        | ((lines.party == Null) & (query.party == Null))))
+                cursor.execute(*join.select(
+                        query.product, query.party, query.quantity,
+                        lines.id,
+                        order_by=[lines.id.asc]))
+                rows = cursor.fetchall()
+                products = {
+                    p.id: p for p in Product.browse({r[0] for r in rows})}
+                matched = set()
+                for product_id, party_id, quantity, line_id in rows:
+                    product = products[product_id]
+                    quantity = product.default_uom.round(quantity)
+                    if line_id is None:
+                        if (product.type == 'goods'
+                                and not product.consumable
+                                and quantity):
+                            missing.append((product_id, party_id, quantity))
+                    elif (product_id, party_id) not in matched:
+                        # Only the first line of a duplicated key gets it
+                        matched.add((product_id, party_id))
+                        quantities[line_id] = quantity
+
+            # Update existing lines
+            for line in inventory.lines:
+                if line.product.type != 'goods':
+                    to_delete.append(line)
+                    continue
+                values = line.update_values4complete(
+                    quantities.get(line.id, 0.0))
+                if values:
+                    to_write.extend(([line], values))
+
+            if not fill:
+                continue
+            # Create lines if needed
+            for product_id, party_id, quantity in missing:
+                values = Line.create_values4complete(inventory, quantity)
+                values['product'] = product_id
+                values['party'] = party_id
+                to_create.append(values)
+        if to_delete:
+            Line.delete(to_delete)
+        if to_create:
+            Line.create(to_create)
+        if to_write:
+            Line.write(*to_write)
+
 
 class InventoryLine(metaclass=PoolMeta):
     __name__ = 'stock.inventory.line'
@@ -281,6 +1966,7 @@ class InventoryLine(metaclass=PoolMeta):
     def get_move(self):
         move = super(InventoryLine, self).get_move()
         if move:
-            if self.party:
-                move.party_used = self.party
+            # Set the stored field to avoid the write of the setter of
+            # party_used when the moves are saved
+            move.party = self.party
         return move
@@ -0,0 +1,218 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+'''
+Benchmark of the owner-aware stock computations.
+
+It builds a synthetic dataset on the database of the test environment and
+writes the timings as JSON, for example:
+
+    DB_NAME=:memory: TRYTOND_DATABASE_URI=sqlite:// python -m \
+        trytond.modules.stock_external_party.tests.benchmark \
+        --products 50 --parties 20 --locations 5 --moves 10000 \
+        --output benchmark.json
+
+Use a postgresql:// URI to run it on a local PostgreSQL server.
+'''
+import argparse
+import datetime
+import json
+import random
+import sys
+import time
+from decimal import Decimal
+
+import trytond
+from trytond import backend
+from trytond.pool import Pool
+from trytond.tests.test_tryton import (
+    activate_module, DB_NAME, USER, CONTEXT)
+from trytond.transaction import Transaction
+
+from trytond.modules.company.tests import create_company, set_company
+
+
+def parse_arguments(args=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark owner-aware stock computations")
+    parser.add_argument('--products', type=int, default=20)
+    parser.add_argument('--parties', type=int, default=10)
+    parser.add_argument('--locations', type=int, default=5)
+    parser.add_argument('--moves', type=int, default=2000)
+    parser.add_argument('--owned-ratio', type=float, default=0.5,
+        help="ratio of moves with a party")
+    parser.add_argument('--runs', type=int, default=3)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark.json')
+    return parser.parse_args(args)
+
+
+def create_dataset(options):
+    'Create the products, parties, locations and done moves'
+    pool = Pool()
+    Template = pool.get('product.template')
+    Product = pool.get('product.product')
+    Party = pool.get('party.party')
+    Uom = pool.get('product.uom')
+    Location = pool.get('stock.location')
+    Move = pool.get('stock.move')
+    rng = random.Random(options.seed)
+
+    unit, = Uom.search([('name', '=', 'Unit')])
+    templates = Template.create([{
+                'name': 'Product %s' % i,
+                'type': 'goods',
+                'list_price': Decimal(0),
+                'cost_price_method': 'fixed',
+                'default_uom': unit.id,
+                'may_belong_to_party': True,
+                } for i in range(options.products)])
+    products = Product.create([{
+                'template': t.id,
+                'cost_price': Decimal(1),
+                } for t in templates])
+    parties = Party.create([{
+                'name': 'Party %s' % i,
+                } for i in range(options.parties)])
+    supplier, = Location.search([('code', '=', 'SUP')])
+    storage, = Location.search([('code', '=', 'STO')])
+    locations = Location.create([{
+                'name': 'Storage %s' % i,
+                'type': 'storage',
+                'parent': storage.id,
+                } for i in range(options.locations)])
+
+    today = datetime.date.today()
+    vlist = []
+    for i in range(options.moves):
+        party = None
+        if rng.random() < options.owned_ratio:
+            party = rng.choice(parties).id
+        date = today - datetime.timedelta(days=rng.randint(2, 365))
+        vlist.append({
+                'product': rng.choice(products).id,
+                'party': party,
+                'uom': unit.id,
+                'quantity': rng.randint(1, 10),
+                'from_location': supplier.id,
+                'to_location': rng.choice(locations).id,
+                'planned_date': date,
+                'effective_date': date,
+                'unit_price': Decimal(1),
+                })
+    for i in range(0, len(vlist), 1000):
+        moves = Move.create(vlist[i:i + 1000])
+        # Skip the origin warnings of the synthetic moves
+        with Transaction().set_user(0):
+            Move.do(moves)
+    return products, parties, locations
+
+
+def timeit(runs, function):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return {
+        'runs': timings,
+        'min': min(timings),
+        'mean': sum(timings) / len(timings),
+        }
+
+
+def run(options):
+    pool = Pool()
+    Party = pool.get('party.party')
+    Product = pool.get('product.product')
+    Move = pool.get('stock.move')
+    Period = pool.get('stock.period')
+    Inventory = pool.get('stock.inventory')
+    Location = pool.get('stock.location')
+    transaction = Transaction()
+
+    company = create_company()
+    results = {}
+    with set_company(company):
+        start = time.perf_counter()
+        products, parties, locations = create_dataset(options)
+        results['create_dataset'] = time.perf_counter() - start
+        party_ids = [p.id for p in parties]
+        product_ids = [p.id for p in products]
+
+        def get_quantity():
+            Party.clear_quantity_cache()
+            Party.read(party_ids, ['quantity', 'forecast_quantity'])
+        results['party_get_quantity'] = timeit(options.runs, get_quantity)
+
+        def search_quantity():
+            Party.search([('quantity', '>', 0)])
+        results['party_search_quantity'] = timeit(
+            options.runs, search_quantity)
+
+        def get_cost_value():
+            with transaction.set_context(
+                    locations=[l.id for l in locations]):
+                Product.read(product_ids, ['cost_value'])
+        results['product_get_cost_value'] = timeit(
+            options.runs, get_cost_value)
+
+        rng = random.Random(options.seed)
+        lost_found, = Location.search([('type', '=', 'lost_found')])
+
+        def assign_try():
+            moves = Move.create([{
+                        'product': rng.choice(products).id,
+                        'party': rng.choice(parties).id,
+                        'uom': products[0].default_uom.id,
+                        'quantity': 1,
+                        'from_location': rng.choice(locations).id,
+                        'to_location': lost_found.id,
+                        'unit_price': Decimal(1),
+                        } for _ in range(100)])
+            Move.assign_try(moves)
+        results['move_assign_try'] = timeit(options.runs, assign_try)
+
+        def complete_lines():
+            inventory, = Inventory.create([{
+                        'location': rng.choice(locations).id,
+                        'date': datetime.date.today(),
+                        }])
+            Inventory.complete_lines([inventory])
+        results['inventory_complete_lines'] = timeit(
+            options.runs, complete_lines)
+
+        # Closing is done once as a period can not be closed twice
+        period, = Period.create([{
+                    'date': datetime.date.today() - datetime.timedelta(days=1),
+                    'company': company.id,
+                    }])
+        results['period_close'] = timeit(1, lambda: Period.close([period]))
+    return results
+
+
+def main(args=None):
+    options = parse_arguments(args)
+    activate_module('stock_external_party')
+    with Transaction().start(DB_NAME, USER, context=CONTEXT):
+        results = run(options)
+        Transaction().rollback()
+    output = {
+        'backend': backend.name,
+        'trytond': trytond.__version__,
+        'parameters': {
+            'products': options.products,
+            'parties': options.parties,
+            'locations': options.locations,
+            'moves': options.moves,
+            'owned_ratio': options.owned_ratio,
+            'runs': options.runs,
+            'seed': options.seed,
+            },
+        'results': results,
+        }
+    with open(options.output, 'w') as f:
+        json.dump(output, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,11 +1,14 @@
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
+import csv
 import datetime
 import unittest
 from dateutil.relativedelta import relativedelta
 from decimal import Decimal
+from io import StringIO
 
 import trytond.tests.test_tryton
+from trytond.config import config
 from trytond.exceptions import UserError
 from trytond.pool import Pool
 from trytond.tests.test_tryton import ModuleTestCase, with_transaction
@@ -77,6 +80,17 @@ class TestCase(ModuleTestCase):
                 party = Party(party.id)
                 self.assertEqual(party.quantity, 5.0)
 
+            # The children of the warehouses are used with many warehouses
+            warehouse, = Location.search([('type', '=', 'warehouse')])
+            Location.copy([warehouse])
+            with transaction.set_context(products=[product.id]):
+                party = Party(party.id)
+                self.assertEqual(party.quantity, 5.0)
+                self.assertEqual(
+                    Party.search([('quantity', '>', 0)]), [party])
+                self.assertEqual(Party.get_quantity([party], 'quantity'),
+                    {party.id: 5.0})
+
             # Send products to customer another time
             move, = Move.create([{
                         'product': product.id,
@@ -104,6 +118,12 @@ class TestCase(ModuleTestCase):
             move = Move(move.id)
             self.assertEqual(move.party_used, party)
 
+            # The party can be removed and set again from the shipment
+            Move.set_shipment_party([shipment], clear=True)
+            self.assertEqual(Move(move.id).party, None)
+            Move.set_shipment_party([shipment])
+            self.assertEqual(Move(move.id).party, party)
+
             self.assertEqual(Shipment.assign_try([shipment]), True)
             Shipment.done([shipment])
 
@@ -125,6 +145,7 @@ class TestCase(ModuleTestCase):
         Location = pool.get('stock.location')
         Move = pool.get('stock.move')
         Period = pool.get('stock.period')
+        PartyBalanceHistory = pool.get('stock.party.balance.history')
         Move.check_origin_types = Mock(return_value=set())
 
         # Create Company
@@ -216,6 +237,120 @@ class TestCase(ModuleTestCase):
                 self.assertEqual(party_cache.internal_quantity,
                     quantities[(party_cache.location, party_cache.party)])
 
+            # Party quantities are excluded in the query
+            with Transaction().set_context(exclude_party_quantities=True):
+                pbl = Product.products_by_location([storage.id],
+                    grouping_filter=([product.id],))
+            self.assertEqual(pbl, {(storage.id, product.id): 3})
+
+            # Quantities at a date use the party cache of the period
+            self.assertEqual(Party.quantities_at(today, [party1, party2],
+                    products=[product], locations=[storage]), {
+                    (storage.id, product.id, party1.id): 5,
+                    (storage.id, product.id, party2.id): 10,
+                    })
+
+            # History starts from the party cache of the period
+            with Transaction().set_context(from_date=today, to_date=today,
+                    locations=[storage.id]):
+                history, = PartyBalanceHistory.search([
+                        ('party', '=', party1.id),
+                        ])
+            self.assertEqual(history.date, today)
+            self.assertEqual(history.location, storage)
+            self.assertEqual(history.quantity, 5)
+
+    @with_transaction()
+    def test0025prune_party_caches(self):
+        'Test prune party caches'
+        pool = Pool()
+        Template = pool.get('product.template')
+        Product = pool.get('product.product')
+        Party = pool.get('party.party')
+        Uom = pool.get('product.uom')
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+        Period = pool.get('stock.period')
+        Move.check_origin_types = Mock(return_value=set())
+
+        company = create_company()
+        with set_company(company):
+            unit, = Uom.search([('name', '=', 'Unit')])
+            template, = Template.create([{
+                        'name': 'Test prune',
+                        'type': 'goods',
+                        'cost_price_method': 'fixed',
+                        'default_uom': unit.id,
+                        'list_price': Decimal(0),
+                        }])
+            product, = Product.create([{
+                        'template': template.id,
+                        }])
+            supplier, = Location.search([('code', '=', 'SUP')])
+            storage, = Location.search([('code', '=', 'STO')])
+
+            party, = Party.create([{
+                        'name': 'Party',
+                        }])
+
+            today = datetime.date.today()
+            moves = Move.create([{
+                        'product': product.id,
+                        'party': party.id,
+                        'uom': unit.id,
+                        'quantity': quantity,
+                        'from_location': supplier.id,
+                        'to_location': storage.id,
+                        'planned_date': today - relativedelta(days=days),
+                        'effective_date': today - relativedelta(days=days),
+                        'unit_price': Decimal('1'),
+                        } for quantity, days in [(5, 3), (2, 2)]])
+            Move.do(moves)
+
+            period1, period2 = Period.create([{
+                        'date': today - relativedelta(days=3),
+                        'company': company.id,
+                        }, {
+                        'date': today - relativedelta(days=2),
+                        'company': company.id,
+                        }])
+            Period.close([period1])
+            Period.close([period2])
+            Period.prune_party_caches()
+
+            self.assertTrue(period1.party_caches_pruned)
+            self.assertEqual(period1.party_caches, ())
+            self.assertFalse(period2.party_caches_pruned)
+            self.assertNotEqual(period2.party_caches, ())
+
+            # Before the latest period the quantities come from the moves
+            self.assertEqual(Party.quantities_at(
+                    today - relativedelta(days=3), [party],
+                    products=[product], locations=[storage]), {
+                    (storage.id, product.id, party.id): 5,
+                    })
+            # After it they come from its party caches
+            self.assertEqual(Party.quantities_at(today, [party],
+                    products=[product], locations=[storage]), {
+                    (storage.id, product.id, party.id): 7,
+                    })
+
+            # A period that can not be closed gets no party cache
+            period3, = Period.create([{
+                        'date': today,
+                        'company': company.id,
+                        }])
+            with self.assertRaises(UserError):
+                Period.close([period3])
+            self.assertEqual(period3.party_caches, ())
+
+            Period.draft([period2])
+            self.assertEqual(period2.party_caches, ())
+            self.assertEqual(Party.quantities_at(today, [party],
+                    products=[product], locations=[storage]), {
+                    (storage.id, product.id, party.id): 7,
+                    })
+
     @with_transaction()
     def test0030inventory(self):
         'Test inventory'
@@ -286,6 +421,320 @@ class TestCase(ModuleTestCase):
             self.assertEqual(line.party, party)
             self.assertEqual(line.expected_quantity, 5.0)
 
+    @with_transaction()
+    def test0040party_balance(self):
+        'Test party balance'
+        pool = Pool()
+        Template = pool.get('product.template')
+        Product = pool.get('product.product')
+        Party = pool.get('party.party')
+        Uom = pool.get('product.uom')
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+        PartyBalance = pool.get('stock.party.balance')
+        Move.check_origin_types = Mock(return_value=set())
+        transaction = Transaction()
+
+        company = create_company()
+        with set_company(company):
+            unit, = Uom.search([('name', '=', 'Unit')])
+            template, = Template.create([{
+                        'name': 'Test party balance',
+                        'type': 'goods',
+                        'cost_price_method': 'fixed',
+                        'default_uom': unit.id,
+                        'list_price': Decimal(0),
+                        }])
+            product, = Product.create([{
+                        'template': template.id,
+                        }])
+            supplier, = Location.search([('code', '=', 'SUP')])
+            storage, = Location.search([('code', '=', 'STO')])
+
+            party1, party2 = Party.create([{
+                        'name': 'Party 1',
+                        }, {
+                        'name': 'Party 2',
+                        }])
+
+            moves = Move.create([{
+                        'product': product.id,
+                        'party': party1.id,
+                        'uom': unit.id,
+                        'quantity': 5,
+                        'from_location': supplier.id,
+                        'to_location': storage.id,
+                        'unit_price': Decimal('1'),
+                        }, {
+                        'product': product.id,
+                        'party': None,
+                        'uom': unit.id,
+                        'quantity': 3,
+                        'from_location': supplier.id,
+                        'to_location': storage.id,
+                        'unit_price': Decimal('1'),
+                        }])
+            Move.do(moves)
+
+            balance, = PartyBalance.search([
+                    ('location', '=', storage.id),
+                    ])
+            self.assertEqual(balance.party, party1)
+            self.assertEqual(balance.internal_quantity, 5.0)
+            self.assertEqual(Product.get_owner_products(), {product.id})
+
+            # Changing the owner of a done move moves the balance
+            Move.write([moves[0]], {'party': party2.id})
+            with transaction.set_context(products=[product.id]):
+                party1, party2 = Party.browse([party1.id, party2.id])
+                self.assertEqual(party1.quantity, 0.0)
+                self.assertEqual(party2.quantity, 5.0)
+                self.assertEqual(Party.search([
+                            ('quantity', '>', 0),
+                            ]), [party2])
+
+            move, = Move.create([{
+                        'product': product.id,
+                        'party': party2.id,
+                        'uom': unit.id,
+                        'quantity': 2,
+                        'from_location': storage.id,
+                        'to_location': supplier.id,
+                        'unit_price': Decimal('1'),
+                        }])
+            self.assertEqual(Move.party_availability([move]), [5.0])
+            self.assertEqual(move.party_available_quantity, 5.0)
+            # Done moves are not checked
+            self.assertEqual(Move.party_availability(
+                    Move.browse([m.id for m in moves])), [None, None])
+
+            # Pages of one row return the same quantities
+            result = PartyBalance.fetch_quantities(limit=None)
+            self.assertIn(
+                [party2.id, product.id, storage.id, 5.0],
+                result['quantities'])
+            self.assertEqual(result['cursor'], None)
+            quantities, cursor = [], None
+            while True:
+                page = PartyBalance.fetch_quantities(cursor=cursor, limit=1)
+                quantities.extend(page['quantities'])
+                cursor = page['cursor']
+                if not cursor:
+                    break
+            self.assertEqual(quantities, result['quantities'])
+            # Only the storage locations are returned
+            self.assertFalse([q for q in result['quantities']
+                    if q[2] != storage.id])
+            with self.assertRaises(UserError):
+                PartyBalance.fetch_quantities(cursor='invalid')
+
+            self.assertEqual(PartyBalance.verify(), [])
+            PartyBalance.rebuild()
+            self.assertEqual(PartyBalance.verify(), [])
+
+    @with_transaction()
+    def test0050assign_try(self):
+        'Test assign try with party'
+        pool = Pool()
+        Template = pool.get('product.template')
+        Product = pool.get('product.product')
+        Party = pool.get('party.party')
+        Uom = pool.get('product.uom')
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+        Move.check_origin_types = Mock(return_value=set())
+
+        company = create_company()
+        with set_company(company):
+            unit, = Uom.search([('name', '=', 'Unit')])
+            template, = Template.create([{
+                        'name': 'Test assign try',
+                        'type': 'goods',
+                        'cost_price_method': 'fixed',
+                        'default_uom': unit.id,
+                        'list_price': Decimal(0),
+                        }])
+            product, = Product.create([{
+                        'template': template.id,
+                        }])
+            supplier, = Location.search([('code', '=', 'SUP')])
+            storage, = Location.search([('code', '=', 'STO')])
+            lost_found, = Location.search([('type', '=', 'lost_found')])
+
+            party, = Party.create([{
+                        'name': 'Party',
+                        }])
+
+            move, = Move.create([{
+                        'product': product.id,
+                        'party': party.id,
+                        'uom': unit.id,
+                        'quantity': 5,
+                        'from_location': supplier.id,
+                        'to_location': storage.id,
+                        'unit_price': Decimal('1'),
+                        }])
+            Move.do([move])
+
+            owned, unowned = Move.create([{
+                        'product': product.id,
+                        'party': party.id,
+                        'uom': unit.id,
+                        'quantity': 5,
+                        'from_location': storage.id,
+                        'to_location': lost_found.id,
+                        'unit_price': Decimal('1'),
+                        }, {
+                        'product': product.id,
+                        'uom': unit.id,
+                        'quantity': 5,
+                        'from_location': storage.id,
+                        'to_location': lost_found.id,
+                        'unit_price': Decimal('1'),
+                        }])
+
+            # The stock of the party goes to the move of the party
+            self.assertFalse(Move.assign_try([owned, unowned]))
+            owned, unowned = Move.browse([owned.id, unowned.id])
+            self.assertEqual(owned.state, 'assigned')
+            self.assertEqual(unowned.state, 'draft')
+
+    @with_transaction()
+    def test0060quantity_snapshot(self):
+        'Test quantity snapshot'
+        pool = Pool()
+        Template = pool.get('product.template')
+        Product = pool.get('product.product')
+        Party = pool.get('party.party')
+        Uom = pool.get('product.uom')
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+        Snapshot = pool.get('stock.party.quantity.snapshot')
+        Move.check_origin_types = Mock(return_value=set())
+
+        company = create_company()
+        with set_company(company):
+            unit, = Uom.search([('name', '=', 'Unit')])
+            template, = Template.create([{
+                        'name': 'Test snapshot',
+                        'type': 'goods',
+                        'cost_price_method': 'fixed',
+                        'default_uom': unit.id,
+                        'list_price': Decimal(0),
+                        }])
+            product, = Product.create([{
+                        'template': template.id,
+                        }])
+            supplier, = Location.search([('code', '=', 'SUP')])
+            storage, = Location.search([('code', '=', 'STO')])
+
+            party, = Party.create([{
+                        'name': 'Party',
+                        }])
+
+            def receive(quantity):
+                move, = Move.create([{
+                            'product': product.id,
+                            'party': party.id,
+                            'uom': unit.id,
+                            'quantity': quantity,
+                            'from_location': supplier.id,
+                            'to_location': storage.id,
+                            'unit_price': Decimal('1'),
+                            }])
+                Move.do([move])
+
+            receive(5)
+            Party.compute_quantity_snapshots([party])
+            snapshot, = Snapshot.search([('party', '=', party.id)])
+            self.assertEqual(snapshot.company, company)
+            self.assertEqual(snapshot.quantity, 5.0)
+            self.assertEqual(snapshot.forecast_quantity, 5.0)
+            self.assertTrue(snapshot.computed_at)
+
+            receive(2)
+            if not config.has_section('stock_external_party'):
+                config.add_section('stock_external_party')
+            config.set('stock_external_party', 'quantity_snapshot', 'True')
+            try:
+                # The quantities are read from the snapshot
+                party = Party(party.id)
+                self.assertEqual(party.quantity, 5.0)
+                self.assertEqual(party.quantity_computed_at,
+                    snapshot.computed_at)
+
+                # Unless a product is in the context
+                with Transaction().set_context(products=[product.id]):
+                    party = Party(party.id)
+                    self.assertEqual(party.quantity, 7.0)
+                    self.assertEqual(party.quantity_computed_at, None)
+            finally:
+                config.remove_option('stock_external_party',
+                    'quantity_snapshot')
+
+            # The snapshot is replaced when computed again
+            Party.compute_quantity_snapshots([party])
+            snapshot, = Snapshot.search([('party', '=', party.id)])
+            self.assertEqual(snapshot.quantity, 7.0)
+
+    @with_transaction()
+    def test0070product_by_party_export(self):
+        'Test product by party export'
+        pool = Pool()
+        Template = pool.get('product.template')
+        Product = pool.get('product.product')
+        Party = pool.get('party.party')
+        Uom = pool.get('product.uom')
+        Location = pool.get('stock.location')
+        Move = pool.get('stock.move')
+        Export = pool.get('product.by_party.export', type='report')
+        Move.check_origin_types = Mock(return_value=set())
+
+        company = create_company()
+        with set_company(company):
+            unit, = Uom.search([('name', '=', 'Unit')])
+            template, = Template.create([{
+                        'name': 'Test export',
+                        'type': 'goods',
+                        'cost_price_method': 'fixed',
+                        'default_uom': unit.id,
+                        'list_price': Decimal(0),
+                        }])
+            product, = Product.create([{
+                        'template': template.id,
+                        'suffix_code': 'EXP',
+                        }])
+            supplier, = Location.search([('code', '=', 'SUP')])
+            storage, = Location.search([('code', '=', 'STO')])
+
+            party, = Party.create([{
+                        'name': 'Party',
+                        }])
+
+            moves = Move.create([{
+                        'product': product.id,
+                        'party': party_id,
+                        'uom': unit.id,
+                        'quantity': 5,
+                        'from_location': supplier.id,
+                        'to_location': storage.id,
+                        'unit_price': Decimal('1'),
+                        } for party_id in [party.id, None]])
+            Move.do(moves)
+
+            oext, content, _, name = Export.execute([], {
+                    'date': None,
+                    'products': [product.id],
+                    })
+            self.assertEqual(oext, 'csv')
+            rows = list(csv.reader(StringIO(content.decode('utf-8'))))
+            self.assertEqual(rows, [
+                    ['Party Code', 'Party', 'Product Code', 'Product',
+                        'Location Code', 'Location', 'Quantity'],
+                    [party.code, 'Party', product.code, 'Test export',
+                        storage.code, storage.name, '5.0'],
+                    ])
+
 
 def suite():
     suite = trytond.tests.test_tryton.suite()